@@ -3,22 +3,59 @@
 
 from __future__ import annotations
 
+import asyncio
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import List
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 import json          # 追加：package.json の読み取り用
-import subprocess    # 追加：npm スクリプト実行用
 import locale        # 追加：コンソールの文字コード取得用
 
-from mcp.server.fastmcp import FastMCP
+try:
+    # あれば C 実装の orjson で package.json をバイト列のままパースする
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+from mcp.server.fastmcp import Context, FastMCP
 
 mcp = FastMCP("ext-server")
 
+WORKSPACE_ROOT: Path
+_WORKSPACE_ROOT_STR: str
+# 絶対パスから相対パスを切り出すときの先頭文字数（区切り文字の分 +1）
+_ROOT_PREFIX_LEN: int
+
+
+def _set_workspace_root(root: Path) -> None:
+    """
+    ワークスペースルートと、そこから派生する文字列・長さをまとめて設定する。
+    3 つは常に揃っている必要があるので、個別に書き換えず必ずここを通す。
+    """
+    global WORKSPACE_ROOT, _WORKSPACE_ROOT_STR, _ROOT_PREFIX_LEN
+    WORKSPACE_ROOT = root
+    _WORKSPACE_ROOT_STR = str(root)
+    _ROOT_PREFIX_LEN = len(_WORKSPACE_ROOT_STR) + 1
+
+
 # このファイルがあるディレクトリをルートとする
-WORKSPACE_ROOT = Path(__file__).resolve().parent
+_set_workspace_root(Path(__file__).resolve().parent)
 
 # 無視したいディレクトリ・拡張子を定義
-IGNORED_DIRS = {".git", "node_modules", ".venv", ".mcp"}
-IGNORED_FILE_SUFFIXES = {
+IGNORED_DIRS = frozenset({".git", "node_modules", ".venv", ".mcp"})
+IGNORED_FILE_SUFFIXES = frozenset({
     ".pyc",
     ".pyo",
     ".png",
@@ -30,8 +67,31 @@ IGNORED_FILE_SUFFIXES = {
     ".tgz",
     ".gz",
     ".lock",
-}
+})
 MAX_READ_BYTES = 200_000  # これ以上大きいファイルは読むのを拒否（約 200KB）
+NPM_OUTPUT_CAP = 1_000_000  # run_npm_script で保持する出力の上限（各ストリームの末尾 約 1MB）
+WALK_BATCH_SIZE = 256  # list_workspace_files_stream で一度に送るパス数
+PATCH_MODES = ("replace_block", "insert_before")  # patch_file で使える mode
+WALK_CACHE_TTL = 0.5  # list_workspace_files の結果を使い回す秒数
+
+# list_workspace_files の走査状態。同時に呼ばれたら実行中の走査結果を共有する
+# 書き込みはワーカースレッドから無効化するので、状態の更新はロックで守る
+_walk_future: Optional[asyncio.Future[List[str]]] = None
+_walk_cached_result: Optional[List[str]] = None
+_walk_cached_at = 0.0
+_walk_generation = 0  # 書き込みのたびに増やし、それ以前に始まった走査の結果は捨てる
+_WALK_LOCK = threading.Lock()
+
+# read_file の結果キャッシュ（キーは (パス, mtime_ns, size)）。スレッドから触るのでロック付き
+READ_CACHE_MAXSIZE = 64
+_READ_CACHE: OrderedDict[Tuple[str, int, int], str] = OrderedDict()
+_READ_CACHE_LOCK = threading.Lock()
+
+# read_file 用の読み込みバッファ。スレッドごとに最大サイズまで育てて使い回す
+_BUF_TLS = threading.local()
+
+# package.json の scripts 名とエラー表示用の一覧文字列のキャッシュ（キーは (mtime_ns, size)）
+_SCRIPTS_CACHE: Dict[Tuple[int, int], Tuple[FrozenSet[str], str]] = {}
 
 # コンソールのエンコーディング（Windows なら cp932、Linux/mac なら utf-8 が入ることが多い）
 CONSOLE_ENCODING = locale.getpreferredencoding(False)
@@ -40,11 +100,86 @@ CONSOLE_ENCODING = locale.getpreferredencoding(False)
 def _safe_path(rel_path: str) -> Path:
     """
     相対パスから絶対パスを作り、WORKSPACE_ROOTの外には出ないようにする
+    シンボリックリンクが張り替えられることがあるので、結果はキャッシュせず毎回解決する
     """
-    p = (WORKSPACE_ROOT / rel_path).resolve()
-    if WORKSPACE_ROOT not in p.parents and p != WORKSPACE_ROOT:
+    p = os.path.realpath(os.path.join(_WORKSPACE_ROOT_STR, rel_path))
+    try:
+        inside = os.path.commonpath((_WORKSPACE_ROOT_STR, p)) == _WORKSPACE_ROOT_STR
+    except ValueError:
+        # Windows でドライブが異なる場合など
+        inside = False
+    if not inside:
         raise ValueError(f"ワークスペース外のパスは参照できません: {p}")
-    return p
+    return Path(p)
+
+
+def _scandir_files(root: Union[str, os.PathLike[str]]) -> Iterator[str]:
+    """
+    root 配下のファイルを再帰的に列挙する（絶対パス）。
+    無視ディレクトリには降りず、DirEntry のキャッシュ済み情報で判定して stat を減らす。
+    """
+    try:
+        it = os.scandir(root)
+    except OSError:
+        # 権限がないなど読めないディレクトリは飛ばす（rglob / os.walk と同じ扱い）
+        return
+
+    with it:
+        for entry in it:
+            name = entry.name
+            # 無視したいディレクトリ配下は丸ごとスキップ
+            if name in IGNORED_DIRS:
+                continue
+
+            # is_dir(follow_symlinks=False) は POSIX では d_type から判定でき stat しない
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scandir_files(entry.path)
+                continue
+
+            # バイナリっぽい拡張子は is_file で stat する前に文字列だけで弾く
+            # （".gz" のようなドットファイルは Path.suffix と同じく拡張子なしとみなす）
+            dot = name.rfind(".")
+            if dot > 0 and name[dot:] in IGNORED_FILE_SUFFIXES:
+                continue
+
+            if entry.is_file(follow_symlinks=False):
+                yield entry.path
+
+
+def _list_files() -> List[str]:
+    """
+    ワークスペース配下のファイル一覧（相対パス）を同期的に作る。
+    """
+    return [p[_ROOT_PREFIX_LEN:] for p in _scandir_files(_WORKSPACE_ROOT_STR)]
+
+
+def _on_walk_done(task: asyncio.Future[List[str]], generation: int) -> None:
+    """
+    走査が終わったら共有中の Future を外し、成功していれば結果をキャッシュする。
+    走査中に書き込みがあった（generation が変わった）場合はキャッシュしない。
+    """
+    global _walk_future, _walk_cached_result, _walk_cached_at
+    with _WALK_LOCK:
+        if _walk_future is task:
+            _walk_future = None
+        if (
+            generation == _walk_generation
+            and not task.cancelled()
+            and task.exception() is None
+        ):
+            _walk_cached_result = task.result()
+            _walk_cached_at = time.monotonic()
+
+
+def _invalidate_walk_cache() -> None:
+    """
+    ファイル一覧のキャッシュを捨て、実行中の走査も以後の呼び出しでは共有しない。
+    """
+    global _walk_future, _walk_cached_result, _walk_generation
+    with _WALK_LOCK:
+        _walk_generation += 1
+        _walk_cached_result = None
+        _walk_future = None
 
 
 @mcp.tool()
@@ -54,23 +189,163 @@ async def list_workspace_files() -> List[str]:
     例: ["package.json", "src/extension.ts", ...]
     node_modules や .git など、明らかなノイズは除外する。
     """
-    results: List[str] = []
-    for path in WORKSPACE_ROOT.rglob("*"):
-        if not path.is_file():
-            continue
+    global _walk_future
+
+    with _WALK_LOCK:
+        # 直前の結果がまだ新しければそのまま返す
+        if (
+            _walk_cached_result is not None
+            and time.monotonic() - _walk_cached_at < WALK_CACHE_TTL
+        ):
+            return list(_walk_cached_result)
+
+        # 走査中なら同じ結果を待つ（走査は 1 本だけ）
+        if _walk_future is None:
+            generation = _walk_generation
+            _walk_future = asyncio.ensure_future(asyncio.to_thread(_list_files))
+            _walk_future.add_done_callback(
+                lambda task: _on_walk_done(task, generation)
+            )
+        walk = _walk_future
+
+    # 呼び出し元がキャンセルされても、共有している走査は止めない
+    return list(await asyncio.shield(walk))
+
+
+def _walk_batches(
+    put: Callable[[Optional[List[str]]], None], stop: threading.Event
+) -> None:
+    """
+    ファイル一覧を WALK_BATCH_SIZE 件ずつ put に渡す。最後に必ず None を渡して終端を知らせる。
+    stop が立ったら走査を打ち切る。
+    """
+    try:
+        batch: List[str] = []
+        for p in _scandir_files(_WORKSPACE_ROOT_STR):
+            if stop.is_set():
+                return
+            batch.append(p[_ROOT_PREFIX_LEN:])
+            if len(batch) >= WALK_BATCH_SIZE:
+                put(batch)
+                batch = []
+        if batch:
+            put(batch)
+    finally:
+        if not stop.is_set():
+            put(None)
 
-        # 無視したいディレクトリ配下はスキップ
-        if any(part in IGNORED_DIRS for part in path.parts):
-            continue
 
-        # バイナリっぽい拡張子はスキップ
-        if path.suffix in IGNORED_FILE_SUFFIXES:
-            continue
+@mcp.tool()
+async def list_workspace_files_stream(ctx: Context) -> List[str]:
+    """
+    list_workspace_files と同じ一覧を返すが、走査は別スレッドで行い、
+    見つかったパスを WALK_BATCH_SIZE 件ずつ進捗通知で先に送る。大きなワークスペース向け。
+
+    各進捗通知の message には、そのバッチの相対パスが改行区切りで入る
+    （progress はそれまでに送った件数、total は走査が終わるまで不明なので付けない）。
+    progressToken を付けずに呼んだ場合は通知は届かず、最後に一覧全体だけが返る。
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[Optional[List[str]]] = asyncio.Queue()
+    stop = threading.Event()
+
+    def put(batch: Optional[List[str]]) -> None:
+        loop.call_soon_threadsafe(queue.put_nowait, batch)
+
+    producer = asyncio.create_task(asyncio.to_thread(_walk_batches, put, stop))
 
-        results.append(str(path.relative_to(WORKSPACE_ROOT)))
+    results: List[str] = []
+    try:
+        while (batch := await queue.get()) is not None:
+            results.extend(batch)
+            await ctx.report_progress(len(results), message="\n".join(batch))
+
+        # 走査中の例外はここで呼び出し元に伝える
+        await producer
+    finally:
+        # 通知の失敗やキャンセルで抜けた場合は、走査スレッドを止めて後始末する
+        if not producer.done():
+            stop.set()
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
     return results
 
 
+def _read_utf8(path: Path, max_bytes: int) -> str:
+    """
+    サイズ確認から UTF-8 での読み取りまでを同期的にまとめて行う。
+    read_file からスレッドに 1 回で投げるためのヘルパー。
+    """
+    # サイズ制限
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"ファイルが存在しません: {path}")
+
+    size = st.st_size
+    if size > max_bytes:
+        raise ValueError(
+            f"ファイルが大きすぎます ({size} bytes > {max_bytes} bytes): {path}"
+        )
+
+    # 更新されていなければキャッシュをそのまま返す
+    key = (str(path), st.st_mtime_ns, size)
+    with _READ_CACHE_LOCK:
+        cached = _READ_CACHE.get(key)
+        if cached is not None:
+            _READ_CACHE.move_to_end(key)
+            return cached
+
+    # サイズは分かっているので、使い回しのバッファに readinto で直接読み込む
+    buf = getattr(_BUF_TLS, "buf", None)
+    if buf is None or len(buf) < size:
+        buf = bytearray(size)
+        _BUF_TLS.buf = buf
+
+    with memoryview(buf) as mv:
+        with open(path, "rb") as f:
+            n = f.readinto(mv[:size])
+            # stat の後にファイルが伸びていた場合は、残りも読んで全体を使う
+            rest = f.read()
+
+        # UTF-8 として読めない場合は明示的にエラーにする
+        try:
+            text = str(bytes(mv[:n]) + rest if rest else mv[:n], "utf-8")
+        except UnicodeDecodeError as e:
+            raise ValueError(
+                f"UTF-8 として読み取れませんでした: {path}\n"
+                f"既存ファイルの文字コードが UTF-8 以外の可能性があります。"
+            ) from e
+
+    # read_text と同じく改行を \n にそろえる
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+    # 読み込み中に伸びたファイルは key の状態と一致しないのでキャッシュしない
+    if rest:
+        return text
+
+    with _READ_CACHE_LOCK:
+        _READ_CACHE[key] = text
+        _READ_CACHE.move_to_end(key)
+        while len(_READ_CACHE) > READ_CACHE_MAXSIZE:
+            _READ_CACHE.popitem(last=False)
+    return text
+
+
+def _invalidate_read_cache(path: Path) -> None:
+    """
+    指定パスのキャッシュを捨てる（mtime の分解能が粗いファイルシステム対策）
+    """
+    path_str = str(path)
+    with _READ_CACHE_LOCK:
+        for key in [k for k in _READ_CACHE if k[0] == path_str]:
+            del _READ_CACHE[key]
+
+
 @mcp.tool()
 async def read_file(rel_path: str) -> str:
     """
@@ -86,25 +361,18 @@ async def read_file(rel_path: str) -> str:
     if path.suffix in IGNORED_FILE_SUFFIXES:
         raise ValueError(f"バイナリファイルは read_file では扱いません: {path}")
 
-    # サイズ制限
-    try:
-        size = path.stat().st_size
-    except FileNotFoundError:
-        raise FileNotFoundError(f"ファイルが存在しません: {path}")
+    return await asyncio.to_thread(_read_utf8, path, MAX_READ_BYTES)
 
-    if size > MAX_READ_BYTES:
-        raise ValueError(
-            f"ファイルが大きすぎます ({size} bytes > {MAX_READ_BYTES} bytes): {path}"
-        )
 
-    # UTF-8 として読めない場合は明示的にエラーにする
-    try:
-        return path.read_text(encoding="utf-8")
-    except UnicodeDecodeError as e:
-        raise ValueError(
-            f"UTF-8 として読み取れませんでした: {path}\n"
-            f"既存ファイルの文字コードが UTF-8 以外の可能性があります。"
-        ) from e
+def _write_utf8(path: Path, content: str) -> None:
+    """
+    親ディレクトリの作成と UTF-8 での書き込みを同期的にまとめて行う。
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # UTF-8 固定で書き込み。Python 内部の str は Unicode なので、ここでのエンコードは一貫して UTF-8 になる。
+    path.write_text(content, encoding="utf-8")
+    _invalidate_read_cache(path)
+    _invalidate_walk_cache()
 
 
 @mcp.tool()
@@ -122,12 +390,197 @@ async def write_file(rel_path: str, content: str) -> str:
     if path.suffix in IGNORED_FILE_SUFFIXES:
         raise ValueError(f"バイナリファイルへの書き込みは許可されていません: {path}")
 
-    path.parent.mkdir(parents=True, exist_ok=True)
-    # UTF-8 固定で書き込み。Python 内部の str は Unicode なので、ここでのエンコードは一貫して UTF-8 になる。
-    path.write_text(content, encoding="utf-8")
+    await asyncio.to_thread(_write_utf8, path, content)
     return f"書き込み完了: {path}"
 
 
+def _detect_newline(data: bytes) -> str:
+    """
+    ファイルの改行コードを判定する（\r\n → \r → \n の順に、最初に見つかったもの）。
+    """
+    if b"\r\n" in data:
+        return "\r\n"
+    if b"\r" in data:
+        return "\r"
+    return "\n"
+
+
+def _to_newline(text: str, newline: str) -> str:
+    """
+    text の改行をいったん \n にそろえてから newline に置き換える。
+    """
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    if newline != "\n":
+        text = text.replace("\n", newline)
+    return text
+
+
+def _patch_utf8(
+    path: Path, ops: List[Dict[str, str]], max_bytes: int
+) -> List[str]:
+    """
+    ファイルを 1 回だけ読み込み、ops を順番に適用して、変化があれば 1 回だけ書き戻す。
+    アンカーが 1 つでも見つからなければ何も書き込まずにエラーにする。
+    """
+    # サイズ制限（read_file と同じ）
+    try:
+        size = path.stat().st_size
+    except FileNotFoundError:
+        raise FileNotFoundError(f"ファイルが存在しません: {path}")
+
+    if size > max_bytes:
+        raise ValueError(
+            f"ファイルが大きすぎます ({size} bytes > {max_bytes} bytes): {path}"
+        )
+
+    original = path.read_bytes()
+    buf = bytearray(original)
+    newline = _detect_newline(original)
+
+    applied: List[str] = []
+    for i, op in enumerate(ops):
+        # read_file は改行を \n にそろえて返すので、ファイル側の改行コードに合わせ直す
+        anchor = _to_newline(op["anchor"], newline).encode("utf-8")
+        replacement = _to_newline(op["replacement"], newline).encode("utf-8")
+        mode = op.get("mode", "replace_block")
+
+        pos = buf.find(anchor)
+        if pos < 0:
+            raise ValueError(f"ops[{i}] のアンカーが見つかりません: {op['anchor']!r}")
+
+        if mode == "replace_block":
+            buf[pos : pos + len(anchor)] = replacement
+        elif buf[max(pos - len(replacement), 0) : pos] == replacement:
+            # 直前に同じ内容がすでに入っていれば挿入しない（何度実行しても同じ結果にする）
+            applied.append(f"ops[{i}] {mode}: 挿入済みのためスキップ @ {pos}")
+            continue
+        else:  # insert_before
+            buf[pos:pos] = replacement
+        applied.append(f"ops[{i}] {mode}: {len(anchor)} bytes @ {pos}")
+
+    # 内容が変わらなければ書き込まない（ウォッチャーの無駄な再ビルドを避ける）
+    if buf == original:
+        applied.append("変更なし（書き込みはスキップ）")
+        return applied
+
+    path.write_bytes(buf)
+    _invalidate_read_cache(path)
+    _invalidate_walk_cache()
+    return applied
+
+
+@mcp.tool()
+async def patch_file(rel_path: str, ops: List[Dict[str, str]]) -> str:
+    """
+    相対パスで指定したファイルに、アンカー文字列を目印にした部分編集をまとめて適用する。
+    読み込み・書き込みはそれぞれ 1 回だけ行う。read_file と同じく大きすぎるファイルはエラーにする。
+
+    ops の各要素:
+        {"anchor": "置き換え/挿入の目印になる文字列",
+         "replacement": "新しい文字列",
+         "mode": "replace_block" | "insert_before"}  # 省略時は replace_block
+
+    replace_block はアンカーの最初の出現を replacement で置き換え、
+    insert_before はアンカーの直前に replacement を挿入する（直前がすでに replacement なら何もしない）。
+    文字コードは UTF-8 固定。
+    read_file は改行を \n にそろえて返すため、anchor / replacement の改行は
+    ファイルの改行コード（\r\n / \r / \n のうち最初に見つかったもの）に変換してから照合・挿入する。
+    read_file の出力をそのままアンカーに使ってよい。
+    """
+    path = _safe_path(rel_path)
+
+    # バイナリっぽい拡張子は念のため拒否
+    if path.suffix in IGNORED_FILE_SUFFIXES:
+        raise ValueError(f"バイナリファイルへの書き込みは許可されていません: {path}")
+
+    for i, op in enumerate(ops):
+        if not op.get("anchor"):
+            raise ValueError(f"ops[{i}] に anchor がありません")
+        if "replacement" not in op:
+            raise ValueError(f"ops[{i}] に replacement がありません")
+        if op.get("mode", "replace_block") not in PATCH_MODES:
+            raise ValueError(
+                f"ops[{i}] の mode が不正です: {op.get('mode')!r}"
+                f"（使えるのは {', '.join(PATCH_MODES)}）"
+            )
+
+    applied = await asyncio.to_thread(_patch_utf8, path, ops, MAX_READ_BYTES)
+    return f"パッチ適用完了: {path}\n" + "\n".join(applied)
+
+
+def _load_script_names(
+    pkg_path: Path, key: Tuple[int, int]
+) -> Tuple[FrozenSet[str], str]:
+    """
+    package.json の scripts 名の集合と、エラー表示用の一覧文字列を返す。
+    (mtime_ns, size) をキーにキャッシュし、ファイルが更新されたときだけ読み直す。
+    """
+    cached = _SCRIPTS_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        pkg_data = _json_loads(pkg_path.read_bytes())
+    except json.JSONDecodeError as e:
+        raise ValueError(f"package.json が不正な JSON です: {e}") from e
+
+    scripts = pkg_data.get("scripts") or {}
+    names = frozenset(scripts)
+    cached = (names, ", ".join(sorted(names)))
+    # 古い版のエントリは不要なので入れ替える
+    _SCRIPTS_CACHE.clear()
+    _SCRIPTS_CACHE[key] = cached
+    return cached
+
+
+async def _drain(stream: asyncio.StreamReader, buf: bytearray, cap: int) -> int:
+    """
+    stream を EOF まで読み、buf に追記する。cap を超えた分は先頭から捨てる。
+    捨てたバイト数を返す。
+    """
+    dropped = 0
+    while chunk := await stream.read(65536):
+        buf += chunk
+        if len(buf) > cap:
+            over = len(buf) - cap
+            del buf[:over]
+            dropped += over
+    return dropped
+
+
+def _format_output(data: bytearray, dropped: int) -> str:
+    """
+    出力をデコードし、先頭を捨てていればその旨を先頭行に付ける。
+    """
+    # デコード不能な文字は置き換え（例外で落ちないように）
+    text = data.decode(CONSOLE_ENCODING, errors="replace")
+    if dropped:
+        return f"(先頭 {dropped} bytes 省略)\n{text}"
+    return text
+
+
+async def _kill_process_tree(proc: asyncio.subprocess.Process) -> None:
+    """
+    proc とその子孫プロセスをまとめて強制終了する。
+    POSIX では start_new_session=True で起動したプロセスグループごと SIGKILL を送り、
+    Windows では taskkill /T /F でプロセスツリーを止める。
+    """
+    if os.name == "nt":
+        killer = await asyncio.create_subprocess_exec(
+            "taskkill", "/T", "/F", "/PID", str(proc.pid),
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        await killer.wait()
+        return
+
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
 # 追加：npm scripts を実行してエラー内容を取得するツール
 @mcp.tool()
 async def run_npm_script(script: str) -> str:
@@ -148,33 +601,49 @@ async def run_npm_script(script: str) -> str:
     if not pkg_path.exists():
         raise FileNotFoundError(f"package.json が見つかりません: {pkg_path}")
 
-    try:
-        pkg_data = json.loads(pkg_path.read_text(encoding="utf-8"))
-    except json.JSONDecodeError as e:
-        raise ValueError(f"package.json が不正な JSON です: {e}") from e
-
-    scripts = pkg_data.get("scripts") or {}
-    if script not in scripts:
+    st = pkg_path.stat()
+    key = (st.st_mtime_ns, st.st_size)
+    names, names_help = _load_script_names(pkg_path, key)
+    if script not in names:
         raise ValueError(
             f"package.json に scripts.{script} が定義されていません。\n"
-            f"定義されているスクリプト: {', '.join(sorted(scripts.keys()))}"
+            f"定義されているスクリプト: {names_help}"
         )
 
     # npm run <script> を実行
     # Windows でも日本語が文字化けしないように、コンソールのエンコーディングでデコードする。
-    proc = subprocess.run(
-        ["npm", "run", script, "--", "--no-color"],
-        cwd=WORKSPACE_ROOT,
-        capture_output=True,
-        text=True,
-        encoding=CONSOLE_ENCODING,
-        errors="replace",  # デコード不能な文字は置き換え（例外で落ちないように）
+    proc = await asyncio.create_subprocess_exec(
+        "npm", "run", script, "--", "--no-color",
+        cwd=str(WORKSPACE_ROOT),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        # 中断時に npm が起動した子プロセスごと止められるよう、別のプロセスグループで起動する
+        start_new_session=True,
     )
+    # 出力は少しずつ読み、各ストリームの末尾 NPM_OUTPUT_CAP バイトだけを残す
+    stdout_b = bytearray()
+    stderr_b = bytearray()
+    finished = False
+    try:
+        stdout_dropped, stderr_dropped = await asyncio.gather(
+            _drain(proc.stdout, stdout_b, NPM_OUTPUT_CAP),
+            _drain(proc.stderr, stderr_b, NPM_OUTPUT_CAP),
+        )
+        await proc.wait()
+        finished = True
+    finally:
+        # キャンセルなどで途中で抜けた場合、npm とその子プロセス（sh, node, esbuild など）を
+        # まとめて止める。子プロセスが残るとパイプが閉じず、wait が終わらない
+        if not finished:
+            await _kill_process_tree(proc)
+            await proc.wait()
+    stdout = _format_output(stdout_b, stdout_dropped)
+    stderr = _format_output(stderr_b, stderr_dropped)
 
     return (
         f"exit_code: {proc.returncode}\n"
-        f"stdout:\n{proc.stdout}\n"
-        f"stderr:\n{proc.stderr}"
+        f"stdout:\n{stdout}\n"
+        f"stderr:\n{stderr}"
     )
 
 
@@ -0,0 +1,516 @@
+# PN.py（MCP サーバー）のファイル操作まわりのテスト
+
+import asyncio
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("mcp")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import PN  # noqa: E402
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    """
+    tmp_path をワークスペースルートにして、キャッシュを空にした状態で使う
+    """
+    original = PN.WORKSPACE_ROOT
+    root = tmp_path.resolve()
+    PN._set_workspace_root(root)
+    PN._READ_CACHE.clear()
+    PN._invalidate_walk_cache()
+    yield root
+    PN._set_workspace_root(original)
+    PN._READ_CACHE.clear()
+    PN._invalidate_walk_cache()
+
+
+def _write(path: Path, text: str) -> None:
+    path.write_bytes(text.encode("utf-8"))
+
+
+# --- patch_file ---
+
+
+def test_patch_missing_anchor_leaves_file_untouched(workspace):
+    target = workspace / "main.js"
+    _write(target, "a();\nb();\n")
+    before = target.stat().st_mtime_ns
+
+    ops = [
+        {"anchor": "a();", "replacement": "x();"},
+        {"anchor": "nope();", "replacement": "y();"},
+    ]
+    with pytest.raises(ValueError):
+        PN._patch_utf8(target, ops, PN.MAX_READ_BYTES)
+
+    assert target.read_bytes() == b"a();\nb();\n"
+    assert target.stat().st_mtime_ns == before
+
+
+def test_patch_applies_multiple_ops_in_order(workspace):
+    target = workspace / "main.js"
+    _write(target, "function f() {\n  foo();\n}\n")
+
+    ops = [
+        {"anchor": "foo();", "replacement": "bar();", "mode": "replace_block"},
+        {"anchor": "  bar();", "replacement": "  init();\n", "mode": "insert_before"},
+        {"anchor": "}", "replacement": "  done();\n", "mode": "insert_before"},
+    ]
+    applied = PN._patch_utf8(target, ops, PN.MAX_READ_BYTES)
+
+    assert len(applied) == 3
+    assert target.read_text(encoding="utf-8") == (
+        "function f() {\n  init();\n  bar();\n  done();\n}\n"
+    )
+
+
+def test_patch_without_change_skips_write(workspace, monkeypatch):
+    target = workspace / "main.js"
+    _write(target, "a();\n")
+
+    def fail_write(self, data):
+        raise AssertionError("write_bytes should not be called")
+
+    monkeypatch.setattr(Path, "write_bytes", fail_write)
+    applied = PN._patch_utf8(
+        target, [{"anchor": "a();", "replacement": "a();"}], PN.MAX_READ_BYTES
+    )
+
+    assert applied[-1] == "変更なし（書き込みはスキップ）"
+
+
+def test_patch_file_rejects_unknown_mode(workspace):
+    _write(workspace / "main.js", "a();\n")
+    ops = [{"anchor": "a();", "replacement": "b();", "mode": "append"}]
+    with pytest.raises(ValueError):
+        asyncio.run(PN.patch_file("main.js", ops))
+
+
+def test_read_file_sees_patch_even_with_same_mtime(workspace):
+    target = workspace / "main.js"
+    _write(target, "old();\n")
+    st = target.stat()
+
+    assert asyncio.run(PN.read_file("main.js")) == "old();\n"
+    asyncio.run(PN.patch_file("main.js", [{"anchor": "old", "replacement": "new"}]))
+    # mtime の分解能が粗いファイルシステムを想定して、mtime を元に戻す
+    os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    assert asyncio.run(PN.read_file("main.js")) == "new();\n"
+
+
+def test_patch_matches_read_file_output_on_crlf_file(workspace):
+    target = workspace / "main.js"
+    target.write_bytes(b"a();\r\nb();\r\n")
+
+    text = asyncio.run(PN.read_file("main.js"))
+    assert text == "a();\nb();\n"
+
+    ops = [{"anchor": "a();\nb();", "replacement": "a();\nc();\nb();"}]
+    asyncio.run(PN.patch_file("main.js", ops))
+
+    assert target.read_bytes() == b"a();\r\nc();\r\nb();\r\n"
+
+
+def test_patch_insert_before_is_idempotent(workspace):
+    target = workspace / "main.js"
+    _write(target, "x\n")
+    ops = [{"anchor": "x", "replacement": "y\n", "mode": "insert_before"}]
+
+    PN._patch_utf8(target, ops, PN.MAX_READ_BYTES)
+    applied = PN._patch_utf8(target, ops, PN.MAX_READ_BYTES)
+
+    assert target.read_bytes() == b"y\nx\n"
+    assert "挿入済みのためスキップ" in applied[0]
+    assert applied[-1] == "変更なし（書き込みはスキップ）"
+
+
+def test_patch_rejects_file_over_size_limit(workspace):
+    target = workspace / "big.js"
+    _write(target, "a" * (PN.MAX_READ_BYTES + 1))
+
+    with pytest.raises(ValueError):
+        asyncio.run(PN.patch_file("big.js", [{"anchor": "a", "replacement": "b"}]))
+
+    assert target.stat().st_size == PN.MAX_READ_BYTES + 1
+
+
+# --- run_npm_script ---
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # 回収待ちのゾンビは終了済みとみなす
+    try:
+        with open(f"/proc/{pid}/stat", encoding="ascii") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except OSError:
+        return True
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX のプロセスグループを使うテスト")
+def test_run_npm_script_cancel_kills_child_processes(workspace, monkeypatch):
+    _write(workspace / "package.json", '{"scripts": {"watch": "x"}}')
+    pid_file = workspace / "child.pid"
+
+    # 長時間動く子プロセスを起動する偽の npm
+    bin_dir = workspace / "bin"
+    bin_dir.mkdir()
+    fake_npm = bin_dir / "npm"
+    _write(
+        fake_npm,
+        "#!/bin/sh\n"
+        "echo started\n"
+        "sleep 30 &\n"
+        f"echo $! > '{pid_file}'\n"
+        "wait\n",
+    )
+    fake_npm.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    async def scenario():
+        task = asyncio.create_task(PN.run_npm_script("watch"))
+        for _ in range(100):
+            if pid_file.exists() and pid_file.read_text().strip():
+                break
+            await asyncio.sleep(0.05)
+        task.cancel()
+        started = time.monotonic()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(scenario())
+    child_pid = int(pid_file.read_text())
+
+    assert elapsed < 5
+    for _ in range(40):
+        if not _process_alive(child_pid):
+            break
+        time.sleep(0.05)
+    assert not _process_alive(child_pid)
+
+
+def test_drain_keeps_tail_and_reports_dropped_bytes():
+    async def scenario():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"x" * 3000)
+        reader.feed_data(b"END")
+        reader.feed_eof()
+        buf = bytearray()
+        dropped = await PN._drain(reader, buf, 1000)
+        return buf, dropped
+
+    buf, dropped = asyncio.run(scenario())
+
+    assert len(buf) == 1000
+    assert buf.endswith(b"END")
+    assert dropped == 2003
+    assert PN._format_output(buf, dropped).startswith("(先頭 2003 bytes 省略)\n")
+    assert PN._format_output(bytearray(b"ok"), 0) == "ok"
+
+
+def test_script_names_are_cached_until_package_json_changes(workspace, monkeypatch):
+    monkeypatch.setattr(PN, "_SCRIPTS_CACHE", {})
+    pkg_path = workspace / "package.json"
+    _write(pkg_path, '{"scripts": {"lint": "x", "build": "y"}}')
+
+    parsed = []
+    json_loads = PN._json_loads
+
+    def counting_loads(data):
+        parsed.append(data)
+        return json_loads(data)
+
+    monkeypatch.setattr(PN, "_json_loads", counting_loads)
+
+    def key():
+        st = pkg_path.stat()
+        return (st.st_mtime_ns, st.st_size)
+
+    names, names_help = PN._load_script_names(pkg_path, key())
+    assert names == frozenset({"lint", "build"})
+    assert names_help == "build, lint"
+    assert PN._load_script_names(pkg_path, key()) == (names, names_help)
+    assert len(parsed) == 1
+
+    _write(pkg_path, '{"scripts": {"test": "z"}}')
+    assert PN._load_script_names(pkg_path, key())[0] == frozenset({"test"})
+    assert len(parsed) == 2
+
+
+def test_json_loads_uses_orjson_when_available():
+    orjson = pytest.importorskip("orjson")
+    assert PN._json_loads is orjson.loads
+
+
+def test_json_loads_falls_back_to_stdlib_without_orjson(monkeypatch):
+    monkeypatch.setitem(sys.modules, "orjson", None)
+    try:
+        importlib.reload(PN)
+        assert PN._json_loads is json.loads
+        # bytes のまま渡しても読めること
+        assert PN._json_loads(b'{"scripts": {"a": "b"}}') == {"scripts": {"a": "b"}}
+    finally:
+        monkeypatch.undo()
+        importlib.reload(PN)
+
+
+# --- ファイル一覧 ---
+
+
+def test_listing_skips_unreadable_directory(workspace, monkeypatch):
+    (workspace / "ok").mkdir()
+    (workspace / "locked").mkdir()
+    _write(workspace / "ok" / "a.txt", "")
+    _write(workspace / "locked" / "b.txt", "")
+
+    scandir = os.scandir
+
+    def fake_scandir(path):
+        if os.path.basename(path) == "locked":
+            raise PermissionError(13, "Permission denied", path)
+        return scandir(path)
+
+    monkeypatch.setattr(PN.os, "scandir", fake_scandir)
+
+    assert asyncio.run(PN.list_workspace_files()) == [os.path.join("ok", "a.txt")]
+
+
+def test_listing_filters_suffixes_on_files_only(workspace):
+    (workspace / "foo.zip").mkdir()
+    (workspace / "node_modules").mkdir()
+    for name in ("foo.zip/in.txt", "node_modules/x.js", ".lock", ".gz", "img.png", "a.js"):
+        _write(workspace / name, "")
+
+    result = sorted(asyncio.run(PN.list_workspace_files()))
+
+    # ドットファイルは拡張子なし扱い、拡張子付きのディレクトリの中身は残す
+    assert result == sorted([".gz", ".lock", "a.js", os.path.join("foo.zip", "in.txt")])
+
+
+def test_concurrent_listings_share_one_walk(workspace, monkeypatch):
+    _write(workspace / "a.txt", "a")
+    walks = []
+    list_files = PN._list_files
+
+    def counting_list_files():
+        walks.append(1)
+        time.sleep(0.05)
+        return list_files()
+
+    monkeypatch.setattr(PN, "_list_files", counting_list_files)
+
+    async def scenario():
+        return await asyncio.gather(*(PN.list_workspace_files() for _ in range(5)))
+
+    results = asyncio.run(scenario())
+
+    assert len(walks) == 1
+    assert all(r == ["a.txt"] for r in results)
+    # 呼び出し元ごとに別のリストを返す
+    assert results[0] is not results[1]
+
+
+def test_list_workspace_files_sees_new_file_after_write(workspace):
+    _write(workspace / "a.txt", "a")
+
+    async def scenario():
+        first = await PN.list_workspace_files()
+        await PN.write_file("new_file.txt", "x")
+        second = await PN.list_workspace_files()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert "new_file.txt" not in first
+    assert "new_file.txt" in second
+
+
+def test_walk_in_flight_during_write_is_not_cached(workspace, monkeypatch):
+    _write(workspace / "a.txt", "a")
+    list_files = PN._list_files
+
+    def slow_list_files():
+        result = list_files()
+        time.sleep(0.2)
+        return result
+
+    monkeypatch.setattr(PN, "_list_files", slow_list_files)
+
+    async def scenario():
+        walk = asyncio.create_task(PN.list_workspace_files())
+        await asyncio.sleep(0.05)
+        await PN.write_file("new_file.txt", "x")
+        await walk
+        return await PN.list_workspace_files()
+
+    assert "new_file.txt" in asyncio.run(scenario())
+
+
+# --- パスの扱い ---
+
+
+def test_safe_path_rechecks_replaced_symlink(workspace, tmp_path_factory):
+    outside = tmp_path_factory.mktemp("outside") / "secret.txt"
+    _write(outside, "secret")
+    target = workspace / "a" / "x.txt"
+    target.parent.mkdir()
+    _write(target, "inside")
+
+    assert asyncio.run(PN.read_file("a/x.txt")) == "inside"
+    target.unlink()
+    target.symlink_to(outside)
+
+    with pytest.raises(ValueError):
+        asyncio.run(PN.read_file("a/x.txt"))
+
+
+def test_safe_path_rejects_parent_escape(workspace):
+    with pytest.raises(ValueError):
+        PN._safe_path("../outside.txt")
+    assert PN._safe_path("src/x.js") == workspace / "src" / "x.js"
+
+
+# --- read_file ---
+
+
+def test_read_reads_rest_of_file_grown_after_stat(workspace, monkeypatch):
+    target = workspace / "grow.txt"
+    _write(target, "abc")
+    stat = Path.stat
+
+    def stat_then_grow(self, *args, **kwargs):
+        result = stat(self, *args, **kwargs)
+        if self == target:
+            with open(target, "ab") as f:
+                f.write("あいう".encode("utf-8"))
+        return result
+
+    monkeypatch.setattr(Path, "stat", stat_then_grow)
+    text = PN._read_utf8(target, PN.MAX_READ_BYTES)
+
+    assert text == "abcあいう"
+    # stat の結果と中身が一致しないのでキャッシュしない
+    assert not PN._READ_CACHE
+
+
+def test_read_normalizes_newlines_like_read_text(workspace):
+    _write(workspace / "crlf.txt", "a\r\nb\rc\n")
+    assert asyncio.run(PN.read_file("crlf.txt")) == "a\nb\nc\n"
+
+
+def test_read_cache_returns_cached_text_until_file_changes(workspace):
+    target = workspace / "notes.txt"
+    _write(target, "aaa")
+
+    first = asyncio.run(PN.read_file("notes.txt"))
+    assert asyncio.run(PN.read_file("notes.txt")) is first
+
+    _write(target, "bbbb")
+    assert asyncio.run(PN.read_file("notes.txt")) == "bbbb"
+
+
+def test_read_file_sees_write_even_with_same_mtime(workspace):
+    target = workspace / "notes.txt"
+    _write(target, "aaa")
+    st = target.stat()
+
+    assert asyncio.run(PN.read_file("notes.txt")) == "aaa"
+    asyncio.run(PN.write_file("notes.txt", "bbb"))
+    # mtime の分解能が粗いファイルシステムを想定して、mtime を元に戻す
+    os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    assert asyncio.run(PN.read_file("notes.txt")) == "bbb"
+
+
+def test_read_reuses_thread_buffer_and_grows_it(workspace, monkeypatch):
+    monkeypatch.setattr(PN, "_BUF_TLS", threading.local())
+    _write(workspace / "mid.txt", "m" * 100)
+    _write(workspace / "small.txt", "s" * 10)
+    _write(workspace / "large.txt", "l" * 1000)
+
+    assert PN._read_utf8(workspace / "mid.txt", PN.MAX_READ_BYTES) == "m" * 100
+    buf = PN._BUF_TLS.buf
+    assert len(buf) == 100
+
+    # 小さいファイルでは同じバッファを使い回し、有効な先頭部分だけをデコードする
+    assert PN._read_utf8(workspace / "small.txt", PN.MAX_READ_BYTES) == "s" * 10
+    assert PN._BUF_TLS.buf is buf
+
+    assert PN._read_utf8(workspace / "large.txt", PN.MAX_READ_BYTES) == "l" * 1000
+    assert len(PN._BUF_TLS.buf) == 1000
+
+
+# --- list_workspace_files_stream ---
+
+
+class _ProgressRecorder:
+    """
+    Context.report_progress の呼び出しを記録する代用品
+    """
+
+    def __init__(self, fail: bool = False):
+        self.calls = []
+        self.fail = fail
+
+    async def report_progress(self, progress, total=None, message=None):
+        if self.fail:
+            raise RuntimeError("progress failed")
+        self.calls.append((progress, total, message))
+
+
+def test_stream_sends_paths_in_batches(workspace, monkeypatch):
+    monkeypatch.setattr(PN, "WALK_BATCH_SIZE", 2)
+    for name in ("a.txt", "b.txt", "c.txt", "d.txt", "e.txt"):
+        _write(workspace / name, "")
+
+    ctx = _ProgressRecorder()
+    result = asyncio.run(PN.list_workspace_files_stream(ctx))
+
+    assert sorted(result) == ["a.txt", "b.txt", "c.txt", "d.txt", "e.txt"]
+    assert [progress for progress, _, _ in ctx.calls] == [2, 4, 5]
+    streamed = [path for _, _, message in ctx.calls for path in message.split("\n")]
+    assert streamed == result
+
+
+def test_stream_stops_walker_when_progress_fails(workspace, monkeypatch):
+    monkeypatch.setattr(PN, "WALK_BATCH_SIZE", 1)
+    for name in ("a.txt", "b.txt", "c.txt"):
+        _write(workspace / name, "")
+
+    stops = []
+    puts = []
+    walk_batches = PN._walk_batches
+
+    def spy(put, stop):
+        stops.append(stop)
+
+        def put_then_wait(batch):
+            puts.append(batch)
+            put(batch)
+            # 呼び出し側が止めるまで次のバッチに進まない
+            if batch is not None:
+                stop.wait(5)
+
+        walk_batches(put_then_wait, stop)
+
+    monkeypatch.setattr(PN, "_walk_batches", spy)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(PN.list_workspace_files_stream(_ProgressRecorder(fail=True)))
+
+    assert stops[0].is_set()
+    # 最初のバッチの後は何も送らずに打ち切られている
+    assert len(puts) == 1